@@ -1,8 +1,13 @@
-import time
 import logging
+import queue
+import signal
+import threading
 from datetime import datetime, date, timedelta
 import calendar
-from typing import Dict, Any, List
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Any, List, Tuple
 
 # ------------------------------------------------------------
 # Основной модуль торгового бота. Здесь реализована логика
@@ -10,6 +15,7 @@ from typing import Dict, Any, List
 # вспомогательные функции.
 # ------------------------------------------------------------
 
+import orjson
 from binance.client import Client
 from binance import ThreadedWebsocketManager
 
@@ -23,32 +29,50 @@ from config import (
     REAL_DEPOSIT, FAKE_DEPOSIT, TRADE_FAKE_REPORT,
 )
 from db import (
-    pg_conn, pg_raw,
+    pg_conn, pg_close_pool, pg_raw, pg_raw_flush, pg_copy_rows,
     pg_upsert_position, pg_delete_position, pg_get_position,
     wipe_mirror, reset_pending,
     pg_upsert_order, pg_delete_order,
+    pg_upsert_orders_many, pg_upsert_positions_many,
     pg_insert_closed_trade, pg_get_closed_trades_for_month,
     pg_purge_old_futures_events,
 )
-from telegram_bot import tg_a, tg_m
+from telegram_bot import tg_a, tg_m, tg_m_many, tg_flush
 from typing import Optional
 
 log = logging.getLogger(__name__)
 
-CHILD_TYPES = {
-    "STOP","STOP_MARKET","STOP_LOSS","STOP_LOSS_LIMIT",
-    "TAKE_PROFIT","TAKE_PROFIT_LIMIT","TAKE_PROFIT_MARKET"
-}
+# Стоп- и тейк-ордера; вместе это дочерние ордера позиции
+STOP_TYPES = frozenset({"STOP","STOP_MARKET","STOP_LOSS","STOP_LOSS_LIMIT"})
+TAKE_TYPES = frozenset({"TAKE_PROFIT","TAKE_PROFIT_LIMIT","TAKE_PROFIT_MARKET"})
+CHILD_TYPES = STOP_TYPES | TAKE_TYPES
+
+# Вид дочернего ордера по его типу: "STOP" или "TAKE"
+CHILD_KIND: Dict[str, str] = {t: "STOP" for t in STOP_TYPES}
+CHILD_KIND.update({t: "TAKE" for t in TAKE_TYPES})
+
+# Лимитные типы (в названии есть LIMIT) — у них должна быть цена
+LIMIT_TYPES = frozenset({"LIMIT","LIMIT_MAKER","STOP_LOSS_LIMIT","TAKE_PROFIT_LIMIT"})
+
+# Синий кружок для сообщений о стопах/тейках
+CHILD_COLOR = "🔵"
 
-# Эти типы ордеров считаются дочерними (стопы/тейки)
+# Цвет кружка по стороне позиции
+_POS_COLOR: Dict[str, str] = {"LONG": "🟢", "SHORT": "🔴"}
+
+# Человекочитаемые названия типов ордеров
+_REASON_MAP: Dict[str, str] = {
+    "MARKET": "(market order)",
+    "LIMIT": "(limit order)",
+    "STOP": "(stop order)",
+    "STOP_MARKET": "(stop market order)",
+    "TAKE_PROFIT": "(take profit order)",
+    "TAKE_PROFIT_MARKET": "(take profit market order)",
+}
 
 def pos_color(side: str) -> str:
     """Вернуть зелёный или красный кружок в зависимости от LONG/SHORT."""
-    return "🟢" if side=="LONG" else "🔴"
-
-def child_color() -> str:
-    """Синий кружок для сообщений о стопах/тейках."""
-    return "🔵"
+    return _POS_COLOR.get(side, "🔴")
 
 def side_name(side: str) -> str:
     """Возвращает строку ``LONG`` или ``SHORT`` в зависимости от стороны."""
@@ -56,15 +80,10 @@ def side_name(side: str) -> str:
 
 def reason_text(otype: str) -> str:
     """Return a human friendly name for an order type."""
-    mp = {
-        "MARKET": "(market order)",
-        "LIMIT": "(limit order)",
-        "STOP": "(stop order)",
-        "STOP_MARKET": "(stop market order)",
-        "TAKE_PROFIT": "(take profit order)",
-        "TAKE_PROFIT_MARKET": "(take profit market order)",
-    }
-    return mp.get(otype, f"({otype.lower()} order)")
+    return _REASON_MAP.get(otype) or f"({otype.lower()} order)"
+
+# Форматтер по умолчанию для символов без известной точности
+_default_fmt = "{:.4f}".format
 
 def _fmt_float(x: float, digits: int = 4) -> str:
     """Форматируем число с плавающей точкой и обрезаем лишние нули."""
@@ -168,23 +187,86 @@ def _format_monthly_table(
 
     return lines
 
+# Сторона позиции по (reduceOnly/closePosition, BUY?) — без ветвлений
+_SIDE_TABLE: Dict[tuple, str] = {
+    (False, True): "LONG",
+    (False, False): "SHORT",
+    (True, True): "SHORT",
+    (True, False): "LONG",
+}
+
 def decode_side_ws(o: Dict[str,Any]) -> str:
     """Определяем сторону позиции на основе сообщения WS."""
-    reduce_flag= bool(o.get("R",False))
-    raw_side  = o["S"]  # "BUY"/"SELL"
+    return _SIDE_TABLE[(bool(o.get("R", False)), o["S"] == "BUY")]
+
+def compute_fill(
+    old_amt: float,
+    fill_qty: float,
+    old_rpnl: float,
+    partial_pnl: float,
+    reduce_flag: bool,
+    coef: float = 1.0,
+) -> Tuple[float, float, float]:
+    """Чистая арифметика исполнения: возвращает (new_amt, new_rpnl, ratio_pct).
+    Объём и PnL исполнения масштабируются на ``coef`` (для зеркального аккаунта)."""
+    qty = fill_qty * coef
+    new_rpnl = old_rpnl + partial_pnl * coef
     if reduce_flag:
-        return "SHORT" if raw_side=="BUY" else "LONG"
+        new_amt = old_amt - qty
     else:
-        return "LONG" if raw_side=="BUY" else "SHORT"
+        new_amt = old_amt + qty
+    ratio = 100.0
+    if old_amt > 1e-12:
+        ratio = (qty / old_amt) * 100
+    if reduce_flag and ratio > 100:
+        ratio = 100.0
+    return new_amt, new_rpnl, ratio
+
+_ORDER_FLOAT_FIELDS = ("ap", "l", "z", "q", "p", "sp", "rp")
+
+def _coerce_order_fields(o: Dict[str,Any]) -> None:
+    """Один раз приводим числовые поля WS-ордера к ``float`` (in-place).
+    Дальше ветки ``_on_order`` читают уже готовые числа без повторных
+    вызовов ``float()``."""
+    for k in _ORDER_FLOAT_FIELDS:
+        v = o.get(k)
+        o[k] = float(v) if v not in (None, "") else 0.0
+
+@dataclass(slots=True, frozen=True)
+class Fill:
+    """Разобранное событие ордера из WebSocket (ORDER_TRADE_UPDATE)."""
+    sym: str
+    otype: str          # e.g. "LIMIT","MARKET"
+    status: str         # "NEW","CANCELED","FILLED"
+    fill_price: float   # цена исполнения
+    fill_qty: float     # исполненный объём (часть)
+    accum_qty: float    # суммарно исполненный объём
+    reduce: bool
+    side: str           # сторона позиции (LONG/SHORT)
+    pnl: float          # PnL части ордера
+    oid: int
+
+    @classmethod
+    def from_ws(cls, o: Dict[str,Any]) -> "Fill":
+        """Собрать ``Fill`` из уже приведённых полей ордера."""
+        return cls(
+            sym=o["s"],
+            otype=o["ot"],
+            status=o["X"],
+            fill_price=o["ap"],
+            fill_qty=o["l"],
+            accum_qty=o["z"],
+            reduce=bool(o.get("R", False)),
+            side=decode_side_ws(o),
+            pnl=o["rp"],
+            oid=int(o.get("i", 0)),
+        )
 
 def decode_side_openorders(raw_side: str, reduce_f: bool, closepos: bool) -> str:
     """Помощник для ``_sync_start`` при разборе открытых ордеров.
     Если выставлен ``reduceOnly`` или ``closePosition`` — направление
     трактуется противоположно (BUY => SHORT)."""
-    if reduce_f or closepos:
-        return "SHORT" if raw_side=="BUY" else "LONG"
-    else:
-        return "LONG" if raw_side=="BUY" else "SHORT"
+    return _SIDE_TABLE[(bool(reduce_f or closepos), raw_side == "BUY")]
 
 class AlexBot:
     """Торговый бот.
@@ -213,10 +295,12 @@ class AlexBot:
             Client(MIRROR_B_API_KEY, MIRROR_B_API_SECRET)
             if self.mirror_enabled else None
         )
-
         # Словари с точностями для каждого символа
         self.lot_size_map = {}
         self.price_size_map = {}
+        # Готовые функции форматирования количества/цены по символу
+        self._qty_fmt_fn = {}
+        self._price_fmt_fn = {}
         # Храним исходные размеры позиций для вычисления процентов
         self.base_sizes = {}
         self.mirror_base_sizes = {}
@@ -224,19 +308,46 @@ class AlexBot:
         self.closed_sizes = {}
         # Initial position sizes to calculate RR and volume on final close
         self.initial_sizes = {}
-        self._init_symbol_precisions()
+        # Последнее записанное в БД состояние позиции по (table, symbol, side)
+        self._pos_written = {}
+        # Текущее состояние позиций в памяти: (table, symbol, side) -> (amt, entry, rpnl).
+        # Бот — единственный писатель этих таблиц, поэтому после _sync_start
+        # чтения обслуживаются отсюда, без SELECT в БД.
+        self._pos_cache = {}
+        self._pos_loaded = False
+        # Независимые стартовые шаги (REST exchangeInfo и сброс таблиц) выполняем параллельно
+        with ThreadPoolExecutor(max_workers=3) as ex:
+            for fn in (self._init_symbol_precisions, wipe_mirror, reset_pending):
+                ex.submit(fn)
+
+        # Ордера зеркального аккаунта отправляются отдельным потоком,
+        # чтобы REST-запросы к Binance не блокировали обработку WS
+        self._mirror_q = queue.Queue()
+        # Вспомогательные REST-проверки (SL/TP после изменения позиции)
+        # выполняются в фоне, не задерживая следующее WS-событие
+        self._bg = ThreadPoolExecutor(max_workers=2, thread_name_prefix="bg")
+        self._mirror_thread = None
+        if self.mirror_enabled:
+            self._mirror_thread = threading.Thread(target=self._mirror_worker, name="mirror", daemon=True)
+            self._mirror_thread.start()
+
+        # Сообщения WS обрабатываются одним рабочим потоком, чтобы не
+        # блокировать поток чтения сокета и сохранить порядок событий
+        self._ws_q = queue.Queue(maxsize=10000)
+        self._ws_thread = threading.Thread(target=self._ws_worker, name="ws-worker", daemon=True)
+        self._ws_thread.start()
 
         # Запуск WebSocket
+        # Внутренняя очередь сокета python-binance по умолчанию — 100 сообщений;
+        # при всплеске событий она переполнялась бы раньше нашей ``_ws_q``
         self.ws = ThreadedWebsocketManager(
             api_key=BINANCE_API_KEY,
-            api_secret=BINANCE_API_SECRET
+            api_secret=BINANCE_API_SECRET,
+            max_queue_size=10000,
         )
         self.ws.start()
         self.ws.start_futures_user_socket(callback=self._ws_handler)
 
-        # Сброс состояния баз в начале работы
-        wipe_mirror()
-        reset_pending()
         self._sync_start()
         self._hello()
 
@@ -271,33 +382,45 @@ class AlexBot:
         log.debug("_init_symbol_precisions called")
         try:
             # Запрашиваем информацию о бирже, чтобы узнать точности торгов
-            info = self.client_a.futures_exchange_info()
-            for s in info["symbols"]:
-                sym_name= s["symbol"]
-                lot_dec, price_dec=4,4
-                for f in s["filters"]:
-                    if f["filterType"]=="LOT_SIZE":
-                        lot_dec= self._step_to_decimals(f["stepSize"])
-                    elif f["filterType"]=="PRICE_FILTER":
-                        price_dec= self._step_to_decimals(f["tickSize"])
-                self.lot_size_map[sym_name]= lot_dec
-                self.price_size_map[sym_name]= price_dec
+            info = self._futures_exchange_info()
+            # Один проход: (symbol, lot_dec, price_dec) для каждого символа
+            step = self._step_to_decimals
+            pairs = [
+                (
+                    s["symbol"],
+                    next((step(f["stepSize"]) for f in s["filters"] if f["filterType"] == "LOT_SIZE"), 4),
+                    next((step(f["tickSize"]) for f in s["filters"] if f["filterType"] == "PRICE_FILTER"), 4),
+                )
+                for s in info["symbols"]
+            ]
+            self.lot_size_map = {k: l for k, l, _ in pairs}
+            self.price_size_map = {k: p for k, _, p in pairs}
+            # Форматтеры готовим один раз, а не на каждое сообщение
+            self._qty_fmt_fn = {k: ("{:." + str(l) + "f}").format for k, l, _ in pairs}
+            self._price_fmt_fn = {k: ("{:." + str(p) + "f}").format for k, _, p in pairs}
             log.info("_init_symbol_precisions: loaded %d symbols", len(info["symbols"]))
         except Exception as e:
             log.error("_init_symbol_precisions: %s", e)
 
+    def _futures_exchange_info(self) -> Dict[str, Any]:
+        """Запрашиваем exchangeInfo через сессию клиента и разбираем ответ orjson
+        (ответ на несколько мегабайт, stdlib json заметно медленнее)."""
+        # URL строит сам клиент — с учётом testnet и версии API
+        resp = self.client_a.session.get(
+            self.client_a._create_futures_api_uri("exchangeInfo"), timeout=10
+        )
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
+
     @staticmethod
     def _step_to_decimals(step_str:str)->int:
         # Превращаем шаг цены/объёма вида "0.001" в количество знаков после запятой
-        s = step_str.rstrip('0')
-        if '.' not in s:
-            return 0
-        return len(s.split('.')[1])
+        exp = Decimal(step_str).normalize().as_tuple().exponent
+        return max(0, -exp)
 
     def _fmt_qty(self, sym:str, qty:float)->str:
         # Форматирование количества с учётом точности символа и добавление названия монеты
-        dec = self.lot_size_map.get(sym, 4)
-        val = f"{qty:.{dec}f}"
+        val = self._qty_fmt_fn.get(sym, _default_fmt)(qty)
         q = val.rstrip('0').rstrip('.') if '.' in val else val
         coin = sym[:-4] if sym.endswith("USDT") else sym
         return f"{q} {coin}"
@@ -308,10 +431,42 @@ class AlexBot:
 
     def _fmt_price(self, sym:str, price:float)->str:
         # Форматирование цены с учётом требуемой точности
-        dec = self.price_size_map.get(sym, 4)
-        val = f"{price:.{dec}f}"
+        val = self._price_fmt_fn.get(sym, _default_fmt)(price)
         return val.rstrip('0').rstrip('.') if '.' in val else val
 
+    def _get_pos(self, table: str, sym: str, side: str) -> Optional[Tuple[float, float, float]]:
+        """(amt, entry_price, realized_pnl) из памяти; до окончания _sync_start — из БД."""
+        if not self._pos_loaded:
+            return pg_get_position(table, sym, side)
+        return self._pos_cache.get((table, sym, side))
+
+    def _write_pos(self, table: str, sym: str, side: str, amt: float, price: float,
+                   pnl: float = 0.0, exchange: str = "binance", pending: bool = False):
+        """
+        UPSERT позиции, пропускаемый, если состояние в БД уже такое же.
+        Кэш обновляется только после успешной записи — он не расходится с БД.
+        """
+        key = (table, sym, side)
+        state = (amt, price, pnl, exchange, pending)
+        if self._pos_written.get(key) == state:
+            self._pos_cache[key] = (amt, price, pnl)
+            return
+        if pg_upsert_position(table, sym, side, amt, price, pnl, exchange, pending):
+            self._pos_cache[key] = (amt, price, pnl)
+            self._pos_written[key] = state
+        else:
+            self._pos_written.pop(key, None)
+
+    def _forget_pos(self, table: str, sym: str, side: str):
+        """Убрать позицию из кэшей (строку в БД удаляет вызывающий)."""
+        self._pos_cache.pop((table, sym, side), None)
+        self._pos_written.pop((table, sym, side), None)
+
+    def _drop_pos(self, table: str, sym: str, side: str):
+        """Удалить позицию из БД и из кэшей."""
+        self._forget_pos(table, sym, side)
+        pg_delete_position(table, sym, side)
+
     def _calc_rr(
         self,
         side: str,
@@ -346,9 +501,7 @@ class AlexBot:
         """Получаем текущий баланс USDT для заданного клиента."""
         try:
             bals = cl.futures_account_balance()
-            for b in bals:
-                if b["asset"] == "USDT":
-                    return float(b["balance"])
+            return next((float(b["balance"]) for b in bals if b["asset"] == "USDT"), 0.0)
         except Exception as e:
             log.error("_usdt: %s", e)
         return 0.0
@@ -356,10 +509,23 @@ class AlexBot:
     def _sync_start(self):
         """Синхронизация состояния при старте бота."""
         log.debug("_sync_start called")
+        # Сообщения о восстановленном состоянии отправляем одной пачкой
+        tg_batch = []
         try:
+            # Позиции и открытые ордера запрашиваем одновременно
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                pos_fut = ex.submit(self.client_a.futures_position_information)
+                ord_fut = ex.submit(self.client_a.futures_get_open_orders)
+                pos_info = pos_fut.result()
+                all_orders = ord_fut.result()
+            # Упорядочиваем по ключу, чтобы пакетный UPSERT шёл по индексу монотонно
+            pos_info.sort(key=lambda p: p["symbol"])
+            all_orders.sort(key=lambda od: (od["symbol"], int(od["orderId"])))
+
             # --- 1) Позиции ---
-            pos_info= self.client_a.futures_position_information()
             real_positions= set()
+            # Строки для пакетного UPSERT: ключ -> (amt, price)
+            pending_positions = {}
             for p in pos_info:
                 # Размер открытой позиции
                 amt = float(p["positionAmt"])
@@ -379,12 +545,22 @@ class AlexBot:
                     f"{side_name(side)} position opened, Volume={self._fmt_qty(sym, vol)}, "
                     f"Price entry={self._fmt_price(sym, prc)}"
                 )
-                tg_m(txt)
-                pg_upsert_position("positions", sym, side, vol, prc, 0.0, "binance", False)
+                tg_batch.append(txt)
+                pending_positions[(sym, side)] = (vol, prc)
+
+            rows = [
+                ("binance", sym, side, vol, prc, 0.0, False)
+                for (sym, side), (vol, prc) in pending_positions.items()
+            ]
+            written = pg_upsert_positions_many("positions", rows)
+            for exch, sym, side, vol, prc, pnl, pending in rows:
+                self._pos_cache[("positions", sym, side)] = (vol, prc, pnl)
+                if written:
+                    self._pos_written[("positions", sym, side)] = (vol, prc, pnl, exch, pending)
 
             # --- 2) Ордера ---
-            all_orders= self.client_a.futures_get_open_orders()
             real_orders= set()
+            pending_orders = {}
 
             for od in all_orders:
                 if od["status"]!="NEW":
@@ -403,7 +579,7 @@ class AlexBot:
                 limit_price= float(od.get("price",0))
 
                 # Проверка limit-like
-                is_limitlike= ("LIMIT" in otype.upper())
+                is_limitlike= otype in LIMIT_TYPES
                 if is_limitlike:
                     # Если limit_price==0 И stp_price==0, пропускаем
                     if limit_price<1e-12 and stp_price<1e-12:
@@ -412,15 +588,16 @@ class AlexBot:
                         continue
 
                 # Определяем главную цену (если это STOP=> stp_price)
-                main_price= stp_price if (otype in CHILD_TYPES and stp_price>1e-12) else limit_price
+                kind = CHILD_KIND.get(otype)
+                is_child = kind is not None
+                main_price= stp_price if (is_child and stp_price>1e-12) else limit_price
 
-                pg_upsert_order(sym, side, oid, orig_qty, main_price, "NEW")
+                pending_orders[(sym, side, oid)] = (orig_qty, main_price, "NEW")
                 real_orders.add((sym, side, oid))
 
                 # Output
-                if otype in CHILD_TYPES:
+                if is_child:
                     # STOP/TAKE
-                    kind = "STOP" if "STOP" in otype else "TAKE"
                     base_amt = self.base_sizes.get((sym, side)) or 0.0
                     qty_for_calc = orig_qty
                     if closepos and orig_qty < 1e-12:
@@ -435,13 +612,13 @@ class AlexBot:
                         elif qty_for_calc > 0:
                             pct_txt = f", Volume {self._fmt_qty(sym, disp_qty)}"
                         txt = (
-                            f"{child_color()} (restart) {sym} {side_name(side)} "
+                            f"{CHILD_COLOR} (restart) {sym} {side_name(side)} "
                             f"{kind} set at {self._fmt_price(sym, main_price)}{pct_txt}"
                         )
                     else:
                         vol_txt = f", Volume {self._fmt_qty(sym, disp_qty)}" if qty_for_calc > 0 else ""
                         txt = (
-                            f"{child_color()} (restart) {sym} {side_name(side)} "
+                            f"{CHILD_COLOR} (restart) {sym} {side_name(side)} "
                             f"{kind} set at {self._fmt_price(sym, main_price)}{vol_txt}"
                         )
                 elif is_limitlike:
@@ -456,29 +633,48 @@ class AlexBot:
                         f"qty={orig_qty}, price={main_price}"
                     )
 
-                tg_m(txt)
+                tg_batch.append(txt)
+
+            pg_upsert_orders_many([k + v for k, v in pending_orders.items()])
 
             # --- 3) Удаляем лишнее из БД ---
+            # Актуальные ключи загружаем во временную таблицу, а разницу
+            # считает сам Postgres (анти-join) — без выгрузки всей таблицы.
+            # Обе таблицы чистятся в одной транзакции с одним коммитом.
             with pg_conn() as conn, conn.cursor() as cur:
                 # positions
-                cur.execute("SELECT symbol, position_side FROM public.positions WHERE exchange='binance'")
-                rows= cur.fetchall()
-                for (db_sym, db_side) in rows:
-                    if (db_sym, db_side) not in real_positions:
-                        log.info("Removing old pos from DB: %s %s", db_sym, db_side)
-                        pg_delete_position("positions", db_sym, db_side)
+                cur.execute("CREATE TEMP TABLE _keep_pos (symbol text, position_side text) ON COMMIT DROP")
+                pg_copy_rows(cur, "_keep_pos", real_positions)
+                cur.execute("""
+                    DELETE FROM public.positions p
+                     WHERE p.exchange='binance'
+                       AND NOT EXISTS (SELECT 1 FROM _keep_pos k
+                                        WHERE k.symbol=p.symbol AND k.position_side=p.position_side)
+                    RETURNING p.symbol, p.position_side
+                """)
+                for (db_sym, db_side) in cur.fetchall():
+                    log.info("Removing old pos from DB: %s %s", db_sym, db_side)
 
-            with pg_conn() as conn, conn.cursor() as cur:
                 # orders
-                cur.execute("SELECT symbol, position_side, order_id FROM public.orders")
-                rows= cur.fetchall()
-                for (db_sym, db_side, db_oid) in rows:
-                    if (db_sym, db_side, db_oid) not in real_orders:
-                        log.info("Removing old order from DB: %s %s %s", db_sym, db_side, db_oid)
-                        pg_delete_order(db_sym, db_side, db_oid)
+                cur.execute("CREATE TEMP TABLE _keep_ord (symbol text, position_side text, order_id bigint) ON COMMIT DROP")
+                pg_copy_rows(cur, "_keep_ord", real_orders)
+                cur.execute("""
+                    DELETE FROM public.orders o
+                     WHERE NOT EXISTS (SELECT 1 FROM _keep_ord k
+                                        WHERE k.symbol=o.symbol AND k.position_side=o.position_side
+                                          AND k.order_id=o.order_id)
+                    RETURNING o.symbol, o.position_side, o.order_id
+                """)
+                for (db_sym, db_side, db_oid) in cur.fetchall():
+                    log.info("Removing old order from DB: %s %s %s", db_sym, db_side, db_oid)
+
+            # БД приведена к состоянию биржи — дальше позиции читаем из памяти
+            self._pos_loaded = True
 
         except Exception as e:
             log.error("_sync_start: %s", e)
+        finally:
+            tg_m_many(tg_batch)
 
 
     # NEW: method called on startup to post info to the mirror chat
@@ -600,54 +796,79 @@ class AlexBot:
 
 
     def _ws_handler(self, msg:Dict[str,Any]):
+        # Вызывается в потоке WebSocket: только кладём сообщение в очередь
+        try:
+            self._ws_q.put_nowait(msg)
+        except queue.Full:
+            log.error("_ws_handler: queue full, message dropped: %s", msg.get("e"))
+
+    def _ws_worker(self):
+        """
+        Разбираем очередь WS-сообщений пачками (до 128 за раз) по порядку.
+        None — сигнал остановки: всё, что пришло до него, обрабатывается.
+        """
+        while True:
+            batch = [self._ws_q.get()]
+            try:
+                while len(batch) < 128:
+                    batch.append(self._ws_q.get_nowait())
+            except queue.Empty:
+                pass
+            for msg in batch:
+                if msg is None:
+                    return
+                try:
+                    self._process_ws(msg)
+                except Exception as e:
+                    log.error("_ws_worker: %s", e)
+
+    def _process_ws(self, msg:Dict[str,Any]):
+        # Все события пишем в futures_events (аудит), но действуем только на ордера.
+        # Сам payload в лог не выводим: repr(dict) на каждое событие в потоке WS
+        # слишком дорог, а полная копия и так лежит в futures_events
         pg_raw(msg)
-        log.debug("[WS] %s", msg)
-        if msg.get("e")=="ORDER_TRADE_UPDATE":
-            self._on_order(msg["o"])
+        if msg.get("e")!="ORDER_TRADE_UPDATE":
+            return
+        self._on_order(msg["o"])
 
     def _on_order(self, o:Dict[str,Any]):
         """Обработка события ордера из WebSocket."""
-        sym     = o["s"]
-        otype   = o["ot"]   # e.g. "LIMIT","MARKET"
-        status  = o["X"]    # "NEW","CANCELED","FILLED"
-        fill_price = float(o.get("ap", 0))  # цена исполнения
-        fill_qty = float(o.get("l", 0))     # исполненный объём (часть)
-        accum_qty = float(o.get("z", fill_qty))  # суммарно исполненный объём
-        reduce_flag = bool(o.get("R", False))
-        partial_pnl = float(o.get("rp", 0.0))  # PnL части ордера
-        order_id = int(o.get("i", 0))
-
-        # Определяем сторону позиции (LONG/SHORT)
-        side = decode_side_ws(o)
+        # "z" может отсутствовать — тогда считаем суммарный объём равным "l"
+        if "z" not in o:
+            o["z"] = o.get("l", 0)
+        _coerce_order_fields(o)
+        f = Fill.from_ws(o)
+        kind = CHILD_KIND.get(f.otype)
+        is_child = kind is not None
 
         # Если статус NEW, проверим, действительно ли этот ордер есть в openOrders
-        if status=="NEW":
+        if f.status=="NEW":
             # Это ключевой фикс: чтобы исключить фантом "Новый LIMIT ... price=0"
             # Делаем API-запрос open_orders по symbol
             try:
-                open_list = self.client_a.futures_get_open_orders(symbol=sym)
+                open_list = self.client_a.futures_get_open_orders(symbol=f.sym)
                 # Проверяем, присутствует ли orderId в списке открытых ордеров
-                found = any(int(x["orderId"]) == order_id for x in open_list)
+                found = any(int(x["orderId"]) == f.oid for x in open_list)
                 if not found:
                     # Это фантом
                     log.info("SKIP phantom 'NEW' order => not in openOrders: sym=%s, side=%s, orderId=%d, type=%s", 
-                             sym, side, order_id, otype)
+                             f.sym, f.side, f.oid, f.otype)
                     return
             except Exception as ee:
-                log.error("Failed to check openOrders for %s: %s", sym, ee)
+                log.error("Failed to check openOrders for %s: %s", f.sym, ee)
 
-        if status == "CANCELED":
-            pg_delete_order(sym, side, order_id)
-            pr = float(o.get("p", 0))
-            sp = float(o.get("sp", 0))
-            q = float(o.get("q", 0))
+        if f.status == "CANCELED":
+            pg_delete_order(f.sym, f.side, f.oid)
+            pr = o["p"]
+            sp = o["sp"]
+            q = o["q"]
 
-            if otype in CHILD_TYPES:
+            if is_child:
                 price = sp if sp > 1e-12 else pr
-                if "TAKE" in otype:
-                    base_amt = (pg_get_position("positions", sym, side) or (0.0,))[0]
+                if kind == "TAKE":
+                    base_amt = (self._get_pos("positions", f.sym, f.side) or (0.0,))[0]
                     if base_amt < 1e-12:
-                        base_amt = self.base_sizes.get((sym, side)) or 0.0
+                        base_amt = self.base_sizes.get((f.sym, f.side)) or 0.0
 
                     qty_for_calc = q
                     if qty_for_calc < 1e-12 and bool(o.get("cp", False)):
@@ -661,90 +882,89 @@ class AlexBot:
                         if pct < 99.99:
                             order_word = "partial take-profit order"
                         pct_txt = f", {pct:.0f}%"
-                        vol_txt = f", Volume {self._fmt_qty(sym, self._display_qty(qty_for_calc))}"
+                        vol_txt = f", Volume {self._fmt_qty(f.sym, self._display_qty(qty_for_calc))}"
 
                     txt = (
-                        f"🔵 {sym} {order_word} canceled. "
-                        f"Target was {self._fmt_price(sym, price)}{pct_txt}{vol_txt}."
+                        f"🔵 {f.sym} {order_word} canceled. "
+                        f"Target was {self._fmt_price(f.sym, price)}{pct_txt}{vol_txt}."
                     )
                 else:
                     txt = (
-                        f"🔵 {sym} stop-loss order canceled. "
-                        f"Target was {self._fmt_price(sym, price)}."
+                        f"🔵 {f.sym} stop-loss order canceled. "
+                        f"Target was {self._fmt_price(f.sym, price)}."
                     )
             else:
                 pct_txt = ""
                 vol_txt = ""
-                order_word = f"{otype} order"
-                if reduce_flag:
-                    base_amt = self.base_sizes.get((sym, side)) or (pg_get_position("positions", sym, side) or (0.0,))[0]
+                order_word = f"{f.otype} order"
+                if f.reduce:
+                    base_amt = self.base_sizes.get((f.sym, f.side)) or (self._get_pos("positions", f.sym, f.side) or (0.0,))[0]
                     if base_amt > 1e-12 and q > 0:
                         pct = (q / base_amt) * 100
                         order_word = "take-profit order"
                         if pct < 99.99:
                             order_word = "partial take-profit order"
                         pct_txt = f", {pct:.0f}%"
-                        vol_txt = f", Volume {self._fmt_qty(sym, self._display_qty(q))}"
+                        vol_txt = f", Volume {self._fmt_qty(f.sym, self._display_qty(q))}"
                         txt = (
-                            f"🔵 {sym} {order_word} canceled at {self._fmt_price(sym, pr)}{pct_txt}{vol_txt}."
+                            f"🔵 {f.sym} {order_word} canceled at {self._fmt_price(f.sym, pr)}{pct_txt}{vol_txt}."
                         )
                     else:
                         disp_q = self._display_qty(q)
                         txt = (
-                            f"🔵 {sym} {otype} order canceled. "
-                            f"Was {pos_color(side)} {side_name(side)}, volume {self._fmt_qty(sym, disp_q)} "
-                            f"at {self._fmt_price(sym, pr)}."
+                            f"🔵 {f.sym} {f.otype} order canceled. "
+                            f"Was {pos_color(f.side)} {side_name(f.side)}, volume {self._fmt_qty(f.sym, disp_q)} "
+                            f"at {self._fmt_price(f.sym, pr)}."
                         )
                 else:
                     disp_q = self._display_qty(q)
                     txt = (
-                        f"🔵 {sym} {otype} order canceled. "
-                        f"Was {pos_color(side)} {side_name(side)}, volume {self._fmt_qty(sym, disp_q)} "
-                        f"at {self._fmt_price(sym, pr)}."
+                        f"🔵 {f.sym} {f.otype} order canceled. "
+                        f"Was {pos_color(f.side)} {side_name(f.side)}, volume {self._fmt_qty(f.sym, disp_q)} "
+                        f"at {self._fmt_price(f.sym, pr)}."
                     )
-            tg_a(txt)
+            tg_a(txt, coalesce=is_child)
             return
 
-        elif status == "EXPIRED":
-            pg_delete_order(sym, side, order_id)
-            pr = float(o.get("p", 0))
-            sp = float(o.get("sp", 0))
-            q = float(o.get("q", 0))
+        elif f.status == "EXPIRED":
+            pg_delete_order(f.sym, f.side, f.oid)
+            pr = o["p"]
+            sp = o["sp"]
+            q = o["q"]
 
-            if otype in CHILD_TYPES:
+            if is_child:
                 price = sp if sp > 1e-12 else pr
-                if "TAKE" in otype:
+                if kind == "TAKE":
                     txt = (
-                        f"🔵 {sym} take-profit order expired. "
-                        f"Target was {self._fmt_price(sym, price)}."
+                        f"🔵 {f.sym} take-profit order expired. "
+                        f"Target was {self._fmt_price(f.sym, price)}."
                     )
                 else:
                     txt = (
-                        f"🔵 {sym} stop-loss order expired. "
-                        f"Target was {self._fmt_price(sym, price)}."
+                        f"🔵 {f.sym} stop-loss order expired. "
+                        f"Target was {self._fmt_price(f.sym, price)}."
                     )
             else:
                 disp_q = self._display_qty(q)
                 txt = (
-                    f"🔵 {sym} {otype} order expired. "
-                    f"Was {pos_color(side)} {side_name(side)}, volume {self._fmt_qty(sym, disp_q)} "
-                    f"at {self._fmt_price(sym, pr)}."
+                    f"🔵 {f.sym} {f.otype} order expired. "
+                    f"Was {pos_color(f.side)} {side_name(f.side)}, volume {self._fmt_qty(f.sym, disp_q)} "
+                    f"at {self._fmt_price(f.sym, pr)}."
                 )
-            tg_a(txt)
+            tg_a(txt, coalesce=is_child)
             return
 
-        elif status == "NEW":
+        elif f.status == "NEW":
             # значит это реально существующий (найден в openOrders)
-            from db import pg_upsert_order
-            orig_qty = float(o.get("q", 0))
+            orig_qty = o["q"]
             close_pos = bool(o.get("cp", False))
-            stp = float(o.get("sp", 0))
-            lmt = float(o.get("p", 0))
+            stp = o["sp"]
+            lmt = o["p"]
 
             # определяем базовый объём позиции
-            pos = pg_get_position("positions", sym, side)
+            pos = self._get_pos("positions", f.sym, f.side)
             curr_amt = pos[0] if pos else 0.0
-            base_amt = curr_amt if curr_amt > 1e-12 else self.base_sizes.get((sym, side)) or 0.0
+            base_amt = curr_amt if curr_amt > 1e-12 else self.base_sizes.get((f.sym, f.side)) or 0.0
 
             if close_pos and orig_qty < 1e-12:
                 # для closePosition количество в событии нулевое
@@ -753,17 +973,16 @@ class AlexBot:
             disp_orig_qty = self._display_qty(orig_qty)
 
             # is limit-like?
-            is_limitlike= ("LIMIT" in otype.upper())
+            is_limitlike= f.otype in LIMIT_TYPES
             if is_limitlike:
                 # если lmt=0 и stp=0 => skip
                 if lmt<1e-12 and stp<1e-12:
-                    log.info("SKIP: new limit-like with 0 price => %s side=%s qty=%.4f type=%s", sym, side, orig_qty, otype)
+                    log.info("SKIP: new limit-like with 0 price => %s side=%s qty=%.4f type=%s", f.sym, f.side, orig_qty, f.otype)
                     return
 
-            if otype in CHILD_TYPES:
+            if is_child:
                 price = stp if stp > 1e-12 else lmt
-                pg_upsert_order(sym, side, order_id, orig_qty, price, "NEW")
-                kind = "STOP" if "STOP" in otype else "TAKE"
+                pg_upsert_order(f.sym, f.side, f.oid, orig_qty, price, "NEW")
                 if kind == "TAKE":
                     pct_txt = ""
                     order_word = "take-profit order"
@@ -771,100 +990,93 @@ class AlexBot:
                         pct = (orig_qty / base_amt) * 100
                         if pct < 99.99:
                             order_word = "partial take-profit order"
-                        pct_txt = f", {pct:.0f}%, Volume {self._fmt_qty(sym, disp_orig_qty)}"
+                        pct_txt = f", {pct:.0f}%, Volume {self._fmt_qty(f.sym, disp_orig_qty)}"
                     txt = (
-                        f"🔵 {sym} {order_word} placed at {self._fmt_price(sym, price)}{pct_txt}."
+                        f"🔵 {f.sym} {order_word} placed at {self._fmt_price(f.sym, price)}{pct_txt}."
                     )
                 else:
                     txt = (
-                        f"🔵 {sym} stop-loss order placed at {self._fmt_price(sym, price)}."
+                        f"🔵 {f.sym} stop-loss order placed at {self._fmt_price(f.sym, price)}."
                     )
-                tg_a(txt)
+                tg_a(txt, coalesce=True)
             else:
-                pg_upsert_order(sym, side, order_id, orig_qty, lmt, "NEW")
-                if reduce_flag:
-                    base_amt = self.base_sizes.get((sym, side)) or 0.0
+                pg_upsert_order(f.sym, f.side, f.oid, orig_qty, lmt, "NEW")
+                if f.reduce:
+                    base_amt = self.base_sizes.get((f.sym, f.side)) or 0.0
                     if base_amt > 1e-12:
                         pct = (orig_qty / base_amt) * 100
                         order_word = "take-profit order"
                         if pct < 99.99:
                             order_word = "partial take-profit order"
-                        pct_txt = f", {pct:.0f}%, Volume {self._fmt_qty(sym, disp_orig_qty)}"
+                        pct_txt = f", {pct:.0f}%, Volume {self._fmt_qty(f.sym, disp_orig_qty)}"
                         txt = (
-                            f"🔵 {sym} {order_word} placed at {self._fmt_price(sym, lmt)}{pct_txt}."
+                            f"🔵 {f.sym} {order_word} placed at {self._fmt_price(f.sym, lmt)}{pct_txt}."
                         )
                         tg_a(txt)
                         return
 
                 pct_txt = ""
-                if reduce_flag:
-                    base_amt = self.base_sizes.get((sym, side)) or 0.0
+                if f.reduce:
+                    base_amt = self.base_sizes.get((f.sym, f.side)) or 0.0
                     if base_amt > 1e-12:
                         pct = (orig_qty / base_amt) * 100
                         pct_txt = f" ({pct:.0f}%)"
-                action = "close" if reduce_flag else ""
+                action = "close" if f.reduce else ""
 
-                side_txt = f"{side_name(side)}{pos_color(side)}"
-                order_kind = "closing " if reduce_flag else ""
+                side_txt = f"{side_name(f.side)}{pos_color(f.side)}"
+                order_kind = "closing " if f.reduce else ""
                 txt = (
-                    f"🔵 {sym} {side_txt} new {order_kind}limit order: "
-                    f"volume {self._fmt_qty(sym, disp_orig_qty)}{pct_txt} at {self._fmt_price(sym, lmt)}."
+                    f"🔵 {f.sym} {side_txt} new {order_kind}limit order: "
+                    f"volume {self._fmt_qty(f.sym, disp_orig_qty)}{pct_txt} at {self._fmt_price(f.sym, lmt)}."
                 )
                 tg_a(txt)
 
-        elif status in ("FILLED", "PARTIALLY_FILLED"):
+        elif f.status in ("FILLED", "PARTIALLY_FILLED"):
             # Удаляем из orders, если это limit-like или child
-            if (("LIMIT" in otype.upper()) or (otype in CHILD_TYPES)):
-                pg_delete_order(sym, side, order_id)
+            if f.otype in LIMIT_TYPES or is_child:
+                pg_delete_order(f.sym, f.side, f.oid)
 
-            if fill_qty<1e-12:
+            if f.fill_qty<1e-12:
                 return
 
-            if otype in CHILD_TYPES:
-                s_p = float(o.get("sp", 0))
-                k = "STOP" if "STOP" in otype else "TAKE"
-                if k == "TAKE":
-                    pos = pg_get_position("positions", sym, side)
-                    base_amt = pos[0] if pos else fill_qty
+            if is_child:
+                s_p = o["sp"]
+                if kind == "TAKE":
+                    pos = self._get_pos("positions", f.sym, f.side)
+                    base_amt = pos[0] if pos else f.fill_qty
                     pct = 0.0
                     if base_amt > 1e-12:
-                        pct = (fill_qty / base_amt) * 100
+                        pct = (f.fill_qty / base_amt) * 100
                     order_word = "take profit order"
                     if pct < 99.99:
                         order_word = "partial take profit order"
                     txt = (
-                        f"{pos_color(side)} {sym} {side_name(side)} {order_word} triggered at {self._fmt_price(sym, s_p)}"
+                        f"{pos_color(f.side)} {f.sym} {side_name(f.side)} {order_word} triggered at {self._fmt_price(f.sym, s_p)}"
                     )
                 else:
                     txt = (
-                        f"{pos_color(side)} {sym} stop order triggered at {self._fmt_price(sym, s_p)}"
+                        f"{pos_color(f.side)} {f.sym} stop order triggered at {self._fmt_price(f.sym, s_p)}"
                     )
                 tg_a(txt)
 
             # positions
-            old_amt, old_entry, old_rpnl= pg_get_position("positions", sym, side) or (0.0,0.0,0.0)
-            new_rpnl= old_rpnl + partial_pnl
-            base_amt = self.base_sizes.get((sym, side), old_amt if old_amt>1e-12 else fill_qty)
+            old_amt, old_entry, old_rpnl= self._get_pos("positions", f.sym, f.side) or (0.0,0.0,0.0)
+            new_amt, new_rpnl, ratio = compute_fill(old_amt, f.fill_qty, old_rpnl, f.pnl, f.reduce)
+            base_amt = self.base_sizes.get((f.sym, f.side), old_amt if old_amt>1e-12 else f.fill_qty)
 
-            if reduce_flag:
+            if f.reduce:
                 # accumulate closed volume for this position
-                self.closed_sizes[(sym, side)] = (
-                    self.closed_sizes.get((sym, side), 0.0) + fill_qty
+                self.closed_sizes[(f.sym, f.side)] = (
+                    self.closed_sizes.get((f.sym, f.side), 0.0) + f.fill_qty
                 )
-                new_amt = old_amt - fill_qty
-                ratio = 100
-                if old_amt > 1e-12:
-                    ratio = (fill_qty / old_amt) * 100
-                if ratio > 100:
-                    ratio = 100
 
                 # Определяем причину закрытия (тейк/стоп/маркет)
                 reason = "market"
                 stop_p = 0.0
                 take_p = 0.0
-                if otype in CHILD_TYPES:
-                    sp_val = float(o.get("sp", 0))
-                    if "STOP" in otype:
+                if is_child:
+                    sp_val = o["sp"]
+                    if kind == "STOP":
                         stop_p = sp_val
                         reason = "stop"
                     else:
@@ -874,7 +1086,7 @@ class AlexBot:
                 if new_amt <= 1e-8:
 
                     closing_vol = old_amt
-                    rr_val = self._calc_rr(side, closing_vol, new_rpnl, old_entry, stop_p, take_p)
+                    rr_val = self._calc_rr(f.side, closing_vol, new_rpnl, old_entry, stop_p, take_p)
                     display_vol = (
                         closing_vol * self.fake_coef if self.use_fake_report else closing_vol
                     )
@@ -883,127 +1095,134 @@ class AlexBot:
                     )
                     reason_word = "stop order" if reason == "stop" else ("take profit order" if reason == "take" else "market")
                     txt = (
-                        f"{pos_color(side)} {sym} {side_name(side)} position closed 100% by {reason_word} "
-                        f"at {self._fmt_price(sym, fill_price)}, Volume: {self._fmt_qty(sym, display_vol)}, "
+                        f"{pos_color(f.side)} {f.sym} {side_name(f.side)} position closed 100% by {reason_word} "
+                        f"at {self._fmt_price(f.sym, f.fill_price)}, Volume: {self._fmt_qty(f.sym, display_vol)}, "
                         f"PnL: {_fmt_float(display_pnl)} usdt"
                     )
                     tg_a(txt)
 
                     pg_insert_closed_trade(
-                        sym,
-                        side,
+                        f.sym,
+                        f.side,
                         closing_vol,
                         new_rpnl,
                         fake_volume=closing_vol * self.fake_coef,
                         fake_pnl=new_rpnl * self.fake_coef,
                         entry_price=old_entry,
-                        exit_price=fill_price,
+                        exit_price=f.fill_price,
                         stop_price=stop_p,
                         take_price=take_p,
                         reason=reason,
                         rr=rr_val,
+                        close_table="positions",
                     )
-                    pg_delete_position("positions", sym, side)
-                    self.base_sizes.pop((sym, side), None)
-                    self.initial_sizes.pop((sym, side), None)
-                    self.closed_sizes.pop((sym, side), None)
+                    self._forget_pos("positions", f.sym, f.side)
+                    self.base_sizes.pop((f.sym, f.side), None)
+                    self.initial_sizes.pop((f.sym, f.side), None)
+                    self.closed_sizes.pop((f.sym, f.side), None)
                 else:
                     new_pct = 0
                     if base_amt > 1e-12:
                         new_pct = (new_amt / base_amt) * 100
                     closed_pct = 0
                     if base_amt > 1e-12:
-                        closed_pct = (fill_qty / base_amt) * 100
+                        closed_pct = (f.fill_qty / base_amt) * 100
                     display_pnl = new_rpnl * self.fake_coef if self.use_fake_report else new_rpnl
-                    disp_closed = self._display_qty(fill_qty)
+                    disp_closed = self._display_qty(f.fill_qty)
                     disp_left = self._display_qty(new_amt)
                     txt = (
-                        f"{pos_color(side)} {sym} {side_name(side)} position decreased "
-                        f"-{self._fmt_qty(sym, disp_closed)} (-{int(closed_pct)}%) -> "
-                        f"{self._fmt_qty(sym, disp_left)} "
-                        f"at {self._fmt_price(sym, fill_price)}, "
+                        f"{pos_color(f.side)} {f.sym} {side_name(f.side)} position decreased "
+                        f"-{self._fmt_qty(f.sym, disp_closed)} (-{int(closed_pct)}%) -> "
+                        f"{self._fmt_qty(f.sym, disp_left)} "
+                        f"at {self._fmt_price(f.sym, f.fill_price)}, "
                         f"current PnL: {_fmt_float(display_pnl)}"
                     )
                     tg_a(txt)
-                    pg_upsert_position("positions", sym, side, new_amt, old_entry, new_rpnl, "binance", False)
-                    self.base_sizes[(sym, side)] = new_amt
+                    self._write_pos("positions", f.sym, f.side, new_amt, old_entry, new_rpnl, "binance", False)
+                    self.base_sizes[(f.sym, f.side)] = new_amt
 
                 if self.mirror_enabled:
                     tg_m(f"[Main] {txt}")
-                    self._mirror_reduce(sym, side, fill_qty, fill_price, partial_pnl, reason)
+                    self._mirror_q.put((self._mirror_reduce, (f.sym, f.side, f.fill_qty, f.fill_price, f.pnl, reason)))
 
                 # warn about outdated protective orders
-                self._warn_protective_orders(sym, side, old_amt, new_amt)
+                self._bg.submit(self._warn_protective_orders, f.sym, f.side, old_amt, new_amt)
             else:
                 if old_amt < 1e-12:
-                    qty = accum_qty if status == "FILLED" else fill_qty
+                    qty = f.accum_qty if f.status == "FILLED" else f.fill_qty
                     new_amt = qty
                     mirror_amt = qty
-                    self.base_sizes[(sym, side)] = new_amt
-                    self.initial_sizes[(sym, side)] = new_amt
-                    self.closed_sizes[(sym, side)] = 0.0
+                    self.base_sizes[(f.sym, f.side)] = new_amt
+                    self.initial_sizes[(f.sym, f.side)] = new_amt
+                    self.closed_sizes[(f.sym, f.side)] = 0.0
                     display_vol = self._display_qty(new_amt)
 
                     txt = (
-                        f"{pos_color(side)} {sym} {side_name(side)} position opened "
-                        f"{reason_text(otype)} {self._fmt_qty(sym, display_vol)} "
-                        f"at {self._fmt_price(sym, fill_price)}"
+                        f"{pos_color(f.side)} {f.sym} {side_name(f.side)} position opened "
+                        f"{reason_text(f.otype)} {self._fmt_qty(f.sym, display_vol)} "
+                        f"at {self._fmt_price(f.sym, f.fill_price)}"
                     )
                 else:
-                    new_amt = old_amt + fill_qty
-                    mirror_amt = fill_qty
-                    disp_add = self._display_qty(fill_qty)
+                    mirror_amt = f.fill_qty
+                    disp_add = self._display_qty(f.fill_qty)
                     disp_new = self._display_qty(new_amt)
                     txt = (
-                        f"{pos_color(side)} {sym} {side_name(side)} position increased "
-                        f"+{self._fmt_qty(sym, disp_add)} -> "
-                        f"{self._fmt_qty(sym, disp_new)} "
-                        f"at {self._fmt_price(sym, fill_price)}"
+                        f"{pos_color(f.side)} {f.sym} {side_name(f.side)} position increased "
+                        f"+{self._fmt_qty(f.sym, disp_add)} -> "
+                        f"{self._fmt_qty(f.sym, disp_new)} "
+                        f"at {self._fmt_price(f.sym, f.fill_price)}"
                     )
-                    self.base_sizes[(sym, side)] = new_amt
-                    prev_initial = self.initial_sizes.get((sym, side), old_amt)
+                    self.base_sizes[(f.sym, f.side)] = new_amt
+                    prev_initial = self.initial_sizes.get((f.sym, f.side), old_amt)
                     # update the initial size to reflect the maximum open
                     # volume observed for this position
-                    self.initial_sizes[(sym, side)] = max(prev_initial, new_amt)
+                    self.initial_sizes[(f.sym, f.side)] = max(prev_initial, new_amt)
 
                 # calculate new average entry price when position size increases
                 if new_amt > 1e-12 and old_amt > 1e-12:
-                    avg_price = (old_entry * old_amt + fill_price * fill_qty) / new_amt
+                    avg_price = (old_entry * old_amt + f.fill_price * f.fill_qty) / new_amt
                 else:
-                    avg_price = fill_price
+                    avg_price = f.fill_price
 
                 tg_a(txt)
-                pg_upsert_position("positions", sym, side, new_amt, avg_price, new_rpnl, "binance", False)
+                self._write_pos("positions", f.sym, f.side, new_amt, avg_price, new_rpnl, "binance", False)
 
                 if self.mirror_enabled:
                     tg_m(f"[Main] {txt}")
-                    self._mirror_increase(sym, side, mirror_amt, fill_price, reason_text(otype))
+                    self._mirror_q.put((self._mirror_increase, (f.sym, f.side, mirror_amt, f.fill_price, reason_text(f.otype))))
 
                 # warn about outdated protective orders
-                self._warn_protective_orders(sym, side, old_amt, new_amt)
+                self._bg.submit(self._warn_protective_orders, f.sym, f.side, old_amt, new_amt)
+
+    def _mirror_worker(self):
+        """Последовательно выполняем задачи зеркального аккаунта из очереди (None — стоп)."""
+        while True:
+            task = self._mirror_q.get()
+            if task is None:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error("_mirror_worker: %s", e)
 
     def _mirror_reduce(self, sym: str, side: str, fill_qty: float, fill_price: float, partial_pnl: float, reason: str):
         old_m_amt, old_m_entry, old_m_rpnl = (
-            pg_get_position("mirror_positions", sym, side) or (0.0, 0.0, 0.0)
+            self._get_pos("mirror_positions", sym, side) or (0.0, 0.0, 0.0)
         )
         dec_qty = fill_qty * MIRROR_COEFFICIENT
-        new_m_pnl = old_m_rpnl + partial_pnl * MIRROR_COEFFICIENT
 
         # if database doesn't contain position amount (e.g. after restart),
         # fall back to stored base size so that notifications show correct volume
         if old_m_amt <= 1e-12:
             old_m_amt = self.mirror_base_sizes.get((sym, side), dec_qty)
 
-        new_m_amt = old_m_amt - dec_qty
+        new_m_amt, new_m_pnl, ratio = compute_fill(
+            old_m_amt, fill_qty, old_m_rpnl, partial_pnl, True, MIRROR_COEFFICIENT
+        )
         base_m_amt = self.mirror_base_sizes.get(
             (sym, side), old_m_amt if old_m_amt > 1e-12 else dec_qty
         )
-
-        ratio = 100
-        if old_m_amt > 1e-12:
-            ratio = (dec_qty / old_m_amt) * 100
-        if ratio > 100:
-            ratio = 100
         side_binance= "BUY" if side=="SHORT" else "SELL"
         try:
             self.client_b.futures_create_order(
@@ -1018,7 +1237,7 @@ class AlexBot:
             tg_m(f"[Mirror]: failed to close position {sym} {side_name(side)}: {e}")
             return
         if new_m_amt<=1e-8:
-            pg_delete_position("mirror_positions", sym, side)
+            self._drop_pos("mirror_positions", sym, side)
             self.mirror_base_sizes.pop((sym, side), None)
             reason_word = "stop order" if reason == "stop" else ("take profit order" if reason == "take" else "market")
             txt = (
@@ -1028,7 +1247,7 @@ class AlexBot:
             )
             tg_m(txt)
         else:
-            pg_upsert_position("mirror_positions", sym, side, new_m_amt, old_m_entry, new_m_pnl, "mirror", False)
+            self._write_pos("mirror_positions", sym, side, new_m_amt, old_m_entry, new_m_pnl, "mirror", False)
             txt = (
                 f"[Mirror]: {pos_color(side)} {sym} {side_name(side)} position decreased "
                 f"-{_fmt_float(dec_qty)} (-{int(ratio)}%) -> {_fmt_float(new_m_amt)} "
@@ -1038,9 +1257,9 @@ class AlexBot:
             self.mirror_base_sizes[(sym, side)] = new_m_amt
 
     def _mirror_increase(self, sym:str, side:str, fill_qty:float, fill_price:float, rtxt:str):
-        old_m_amt, old_m_entry, old_m_rpnl= pg_get_position("mirror_positions", sym, side) or (0.0,0.0,0.0)
+        old_m_amt, old_m_entry, old_m_rpnl= self._get_pos("mirror_positions", sym, side) or (0.0,0.0,0.0)
         inc_qty= fill_qty*MIRROR_COEFFICIENT
-        new_m_amt= old_m_amt+ inc_qty
+        new_m_amt, _, _ = compute_fill(old_m_amt, fill_qty, old_m_rpnl, 0.0, False, MIRROR_COEFFICIENT)
         base_m_amt = self.mirror_base_sizes.get((sym, side), new_m_amt if old_m_amt<1e-12 else old_m_amt)
         side_binance= "BUY" if side=="LONG" else "SELL"
 
@@ -1061,7 +1280,7 @@ class AlexBot:
         else:
             m_avg_price = fill_price
 
-        pg_upsert_position("mirror_positions", sym, side, new_m_amt, m_avg_price, old_m_rpnl, "mirror", False)
+        self._write_pos("mirror_positions", sym, side, new_m_amt, m_avg_price, old_m_rpnl, "mirror", False)
 
         if old_m_amt < 1e-12:
             self.mirror_base_sizes[(sym, side)] = new_m_amt
@@ -1098,7 +1317,8 @@ class AlexBot:
             if od.get("status") != "NEW":
                 continue
             otype = od.get("type", "")
-            if otype not in CHILD_TYPES:
+            ckind = CHILD_KIND.get(otype)
+            if ckind is None:
                 continue
             raw_side = od.get("side", "")
             reduce_f = bool(od.get("reduceOnly", False))
@@ -1109,7 +1329,7 @@ class AlexBot:
             qty = float(od.get("origQty", 0))
             if abs(qty - new_amt) <= 1e-8:
                 continue
-            kind = "take-profit" if "TAKE_PROFIT" in otype else "stop-loss"
+            kind = "take-profit" if ckind == "TAKE" else "stop-loss"
             msg = (
                 f"⚠️ {symbol} {side_name(side)}. Position size changed "
                 f"from {self._fmt_qty(symbol, self._display_qty(old_amt))} to "
@@ -1187,8 +1407,24 @@ class AlexBot:
         pg_purge_old_futures_events(FUTURES_EVENTS_RETENTION_DAYS)
         self._last_purge_date = today
 
+    def _stop_workers(self):
+        """
+        Дорабатываем очереди при остановке: сначала WS-события (они порождают
+        задачи зеркала и фоновые проверки), затем зеркало, затем фон.
+        """
+        self._ws_q.put(None)
+        self._ws_thread.join()
+        if self._mirror_thread is not None:
+            self._mirror_q.put(None)
+            self._mirror_thread.join()
+        self._bg.shutdown(wait=True)
+
     def run(self):
         log.debug("AlexBot.run called")
+        # Ctrl+C / SIGTERM только выставляют событие остановки, основной поток спит в wait()
+        self._stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: self._stop.set())
         try:
             log.info("[Main] bot running ... Ctrl+C to stop")
 
@@ -1196,13 +1432,17 @@ class AlexBot:
             self._maybe_monthly_report(send_fn=tg_m, prefix="Mirror chat output", detailed=True, fake=False)
             self._maybe_purge_events()
 
-            # Основной цикл бота
+            # Основной цикл бота: отчёт/очистка проверяются раз в минуту
             while True:
                 self._maybe_monthly_report(fake=self.use_fake_report)
                 self._maybe_purge_events()
-                time.sleep(1)
-        except KeyboardInterrupt:
+                if self._stop.wait(60):
+                    break
             tg_m("⏹️  Bot stopped by user")
         finally:
             self.ws.stop()
-            log.info("[Main] bye.")
\ No newline at end of file
+            self._stop_workers()
+            pg_raw_flush()
+            tg_flush()
+            pg_close_pool()
+            log.info("[Main] bye.")
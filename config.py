@@ -47,6 +47,10 @@ MONTHLY_REPORT_ON_START = os.getenv("MONTHLY_REPORT_ON_START", "false").lower()
 
 # ---- Через сколько дней очищать таблицу futures_events ----
 FUTURES_EVENTS_RETENTION_DAYS = int(os.getenv("FUTURES_EVENTS_RETENTION_DAYS", "60"))
+# Какие типы WS-событий сохранять в futures_events (через запятую); пусто — все
+FUTURES_EVENTS_TYPES = frozenset(
+    t.strip() for t in os.getenv("FUTURES_EVENTS_TYPES", "").split(",") if t.strip()
+)
 
 # ---- Параметры отображения отчётности ----
 REAL_DEPOSIT = float(os.getenv("REAL_DEPOSIT", "20000"))
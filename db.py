@@ -1,8 +1,17 @@
-import psycopg2
-import json
+import io
 import logging
+import queue
+import threading
+import time
+import orjson
+from contextlib import contextmanager
+from datetime import datetime
+from psycopg2 import errors as pg_errors
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from typing import Dict, Any, Optional, Tuple
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, FUTURES_EVENTS_TYPES
 
 # ------------------------------------------------------------
 # Модуль работы с базой данных PostgreSQL. Здесь находятся
@@ -13,18 +22,201 @@ from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
 log = logging.getLogger(__name__)
 
 
+class _PreparingConnection(PgConnection):
+    """Соединение пула, которое помнит свои подготовленные (PREPARE) запросы."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+_POOL: Optional[ThreadedConnectionPool] = None
+_POOL_LOCK = threading.Lock()
+_POOL_CLOSED = False
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    """Лениво создаёт общий пул соединений с PostgreSQL."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            # После pg_close_pool новый пул не открываем
+            if _POOL_CLOSED:
+                raise RuntimeError("Postgres pool is closed")
+            if _POOL is None:
+                # Проверяем, что все переменные окружения заданы
+                if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
+                    raise RuntimeError("Postgres env-vars incomplete")
+                # Формируем DSN-строку для подключения
+                dsn = (
+                    f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} "
+                    f"user={DB_USER} password={DB_PASSWORD} sslmode=require"
+                )
+                # Соединения нужны лишь нескольким потокам (ws-worker, mirror,
+                # pg-raw, основной и стартовый пул), поэтому 10 с запасом
+                # TCP keepalive: простаивающие соединения пула не обрываются
+                # по таймауту NAT/балансировщика между всплесками событий
+                _POOL = ThreadedConnectionPool(minconn=2, maxconn=10, dsn=dsn,
+                                               connection_factory=_PreparingConnection,
+                                               keepalives=1, keepalives_idle=30,
+                                               keepalives_interval=10, keepalives_count=3)
+    return _POOL
+
+
+def pg_close_pool():
+    """Закрываем все соединения пула (при остановке бота); повторно он не откроется."""
+    global _POOL, _POOL_CLOSED
+    with _POOL_LOCK:
+        _POOL_CLOSED = True
+        if _POOL is not None:
+            _POOL.closeall()
+            _POOL = None
+
+
+@contextmanager
 def pg_conn():
-    """Создаёт и возвращает соединение с PostgreSQL."""
-    # Проверяем, что все переменные окружения заданы
-    if not all([DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]):
-        raise RuntimeError("Postgres env-vars incomplete")
-    # Формируем DSN-строку для подключения
-    dsn = (
-        f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} "
-        f"user={DB_USER} password={DB_PASSWORD} sslmode=require"
-    )
-    # Возвращаем открытое подключение
-    return psycopg2.connect(dsn)
+    """
+    Выдаёт соединение из пула. При успешном выходе из блока транзакция
+    фиксируется, при исключении — откатывается; соединение возвращается в пул.
+    """
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception as e:
+        if not conn.closed:
+            conn.rollback()
+            # Кэш подготовленных запросов разошёлся с сервером — сбрасываем его
+            if isinstance(e, _PREPARED_ERRORS):
+                _deallocate(conn)
+        raise
+    finally:
+        # Разорванное соединение в пул не возвращаем
+        pool.putconn(conn, close=bool(conn.closed))
+
+# UPSERT позиции: общий текст для одиночного (PREPARE) и пакетного
+# (execute_values) пути, чтобы они не разъехались
+_UPSERT_POS_SQL = """
+    INSERT INTO public.{table}
+           (exchange, symbol, position_side,
+            position_amt, entry_price, realized_pnl, pending)
+    VALUES {values}
+    ON CONFLICT (symbol, position_side)
+    DO UPDATE SET
+       exchange      = EXCLUDED.exchange,
+       position_amt  = EXCLUDED.position_amt,
+       entry_price   = EXCLUDED.entry_price,
+       realized_pnl  = EXCLUDED.realized_pnl,
+       pending       = EXCLUDED.pending,
+       updated_at    = now()
+"""
+
+# UPSERT ордера: общий текст для одиночного и пакетного пути
+_UPSERT_ORD_SQL = """
+    INSERT INTO public.{table} (symbol, position_side, order_id,
+                                qty, price, status)
+    VALUES {values}
+    ON CONFLICT (symbol, position_side, order_id)
+    DO UPDATE SET
+      qty     = EXCLUDED.qty,
+      price   = EXCLUDED.price,
+      status  = EXCLUDED.status,
+      updated_at = now()
+"""
+
+# Частые запросы по позициям и ордерам: разбираются и планируются сервером
+# один раз на соединение (PREPARE), дальше выполняются через EXECUTE
+_PREPARED_SQL: Dict[str, str] = {
+    "upsert_pos": _UPSERT_POS_SQL.format(
+        table="{table}", values="($1, $2, $3, $4, $5, $6, $7)"),
+    "get_pos": """
+        SELECT position_amt, entry_price, realized_pnl
+          FROM public.{table}
+         WHERE symbol=$1 AND position_side=$2
+    """,
+    "del_pos": "DELETE FROM public.{table} WHERE symbol=$1 AND position_side=$2",
+    "upsert_ord": _UPSERT_ORD_SQL.format(
+        table="{table}", values="($1, $2, $3, $4, $5, $6)"),
+    "del_ord": """
+        DELETE FROM public.{table}
+         WHERE symbol=$1 AND position_side=$2 AND order_id=$3
+    """,
+}
+
+# Допустимые таблицы для каждого запроса; имя таблицы попадает в текст SQL,
+# поэтому всё, чего нет в этом списке, отвергается
+_PREPARED_TABLES: Dict[str, Tuple[str, ...]] = {
+    "upsert_pos": ("positions", "mirror_positions"),
+    "get_pos": ("positions", "mirror_positions"),
+    "del_pos": ("positions", "mirror_positions"),
+    "upsert_ord": ("orders",),
+    "del_ord": ("orders",),
+}
+
+def _build_statements() -> Dict[Tuple[str, str], Tuple[str, str, str]]:
+    """(запрос, таблица) -> (имя, текст PREPARE, текст EXECUTE), собирается один раз."""
+    out = {}
+    for name, tables in _PREPARED_TABLES.items():
+        sql = _PREPARED_SQL[name]
+        nparams = sql.count("$")
+        for table in tables:
+            stmt = f"{name}_{table}"
+            out[(name, table)] = (
+                stmt,
+                f"PREPARE {stmt} AS " + sql.format(table=table),
+                f"EXECUTE {stmt} (" + ", ".join(["%s"] * nparams) + ")",
+            )
+    return out
+
+_STATEMENTS = _build_statements()
+
+def _execute_prepared(cur, name: str, table: str, params: tuple):
+    """Выполнить запрос из ``_PREPARED_SQL``, при первом вызове на соединении — PREPARE."""
+    try:
+        stmt, prepare_sql, execute_sql = _STATEMENTS[(name, table)]
+    except KeyError:
+        raise ValueError(f"unknown table for {name}: {table!r}") from None
+    conn = cur.connection
+    if stmt not in conn.prepared:
+        cur.execute(prepare_sql)
+        conn.prepared.add(stmt)
+    cur.execute(execute_sql, params)
+
+# Ошибки, означающие, что набор PREPARE на сервере не совпал с ``conn.prepared``
+# (запрос пропал или уже существует, например после переподключения через пулер)
+_PREPARED_ERRORS = (pg_errors.InvalidSqlStatementName, pg_errors.DuplicatePreparedStatement)
+
+def _deallocate(conn):
+    """Сбросить подготовленные запросы соединения на сервере и в кэше — PREPARE повторится."""
+    conn.prepared.clear()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DEALLOCATE ALL")
+        conn.commit()
+    except Exception as e:
+        log.error("_deallocate: %s", e)
+
+# Экранирование для текстового формата COPY
+_COPY_ESCAPE = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_value(v) -> str:
+    """Значение в текстовом формате COPY: None -> \\N, спецсимволы экранируются."""
+    if v is None:
+        return "\\N"
+    return str(v).translate(_COPY_ESCAPE)
+
+def pg_copy_rows(cur, table: str, rows):
+    """
+    Загружаем строки в таблицу через ``COPY ... FROM STDIN`` в рамках
+    переданного курсора. ``table`` может включать список колонок.
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(map(_copy_value, row)))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} FROM STDIN", buf)
 
 def pg_upsert_order(symbol: str,
                     side: str,
@@ -38,21 +230,27 @@ def pg_upsert_order(symbol: str,
     try:
         # Открываем соединение с БД и выполняем UPSERT
         with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-              INSERT INTO public.orders (symbol, position_side, order_id,
-                                         qty, price, status)
-              VALUES (%s, %s, %s, %s, %s, %s)
-              ON CONFLICT (symbol, position_side, order_id)
-              DO UPDATE SET
-                qty     = EXCLUDED.qty,
-                price   = EXCLUDED.price,
-                status  = EXCLUDED.status,
-                updated_at = now();
-            """, (symbol, side, order_id, qty, price, status))
+            _execute_prepared(cur, "upsert_ord", "orders",
+                              (symbol, side, order_id, qty, price, status))
     except Exception as e:
         # Логируем ошибку, но не поднимаем исключение наверх
         log.error("pg_upsert_order: %s", e)
 
+def pg_upsert_orders_many(rows):
+    """
+    Пакетный UPSERT в orders одним запросом.
+    rows: (symbol, side, order_id, qty, price, status); ключи не должны повторяться.
+    """
+    if not rows:
+        return
+    try:
+        with pg_conn() as conn, conn.cursor() as cur:
+            execute_values(cur,
+                           _UPSERT_ORD_SQL.format(table="orders", values="%s"),
+                           rows, page_size=500)
+    except Exception as e:
+        log.error("pg_upsert_orders_many: %s", e)
+
 def pg_delete_order(symbol: str, side: str, order_id: int):
     """
     Удаляем конкретный лимит-ордер.
@@ -60,36 +258,109 @@ def pg_delete_order(symbol: str, side: str, order_id: int):
     try:
         # Подключаемся к БД и удаляем запись по ключу
         with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                DELETE FROM public.orders
-                 WHERE symbol=%s
-                   AND position_side=%s
-                   AND order_id=%s
-            """, (symbol, side, order_id))
+            _execute_prepared(cur, "del_ord", "orders", (symbol, side, order_id))
     except Exception as e:
         # При ошибке просто пишем в лог
         log.error("pg_delete_order: %s", e)
         
+# Очередь "сырых" WS-событий: пишутся в futures_events фоновым потоком пачками
+_RAW_Q: "queue.Queue[tuple]" = queue.Queue(maxsize=10000)
+_RAW_BATCH = 100      # максимум строк в одном COPY
+_RAW_WAIT = 0.05      # сколько ждать добора пачки, секунд
+_RAW_LOCK = threading.Lock()
+_raw_thread: Optional[threading.Thread] = None
+_raw_stopped = False
+_raw_dropped = 0
+
+
 def pg_raw(msg: Dict[str, Any]):
     """
     Сохраняем ВСЁ WS‑сообщение в futures_events.
+    Сообщение сериализуется сразу и ставится в очередь, саму запись (COPY)
+    выполняет фоновый поток — вызывающий поток не ждёт БД.
     """
+    global _raw_thread, _raw_dropped
+    # Если задан список нужных типов событий, остальные не сохраняем
+    if FUTURES_EVENTS_TYPES and msg.get("e") not in FUTURES_EVENTS_TYPES:
+        return
+    # После pg_raw_flush писатель остановлен — поздние события не принимаем
+    if _raw_stopped:
+        return
+    if _raw_thread is None:
+        with _RAW_LOCK:
+            if _raw_thread is None and not _raw_stopped:
+                _raw_thread = threading.Thread(target=_raw_writer, name="pg-raw", daemon=True)
+                _raw_thread.start()
     try:
-        # Сохраняем входящий WS-пакет как есть, в "сырую" таблицу
-        with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO public.futures_events
-                       (exchange, event_type, symbol, raw_data)
-                VALUES (%s, %s, %s, %s)
-            """, (
-                "binance",
-                msg.get("e"),
-                msg.get("o", {}).get("s"),
-                json.dumps(msg)
-            ))
+        _RAW_Q.put_nowait((
+            "binance",
+            msg.get("e"),
+            msg.get("o", {}).get("s"),
+            orjson.dumps(msg).decode()
+        ))
+    except queue.Full:
+        _raw_dropped += 1
+        log.error("pg_raw: queue full, %d events dropped", _raw_dropped)
     except Exception as e:
         log.error("pg_raw: %s", e)
 
+def _raw_writer():
+    """
+    Фоновая запись futures_events: до _RAW_BATCH строк или _RAW_WAIT секунд.
+    None в очереди — сигнал остановки: пачка до него дописывается, поток выходит.
+    """
+    while True:
+        item = _RAW_Q.get()
+        if item is None:
+            return
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + _RAW_WAIT
+        while len(batch) < _RAW_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _RAW_Q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        try:
+            # COPY — самый быстрый путь для потока событий (без разбора INSERT).
+            # Журнал событий не критичен: коммит не ждёт сброса WAL на диск
+            with pg_conn() as conn, conn.cursor() as cur:
+                cur.execute("SET LOCAL synchronous_commit = off")
+                pg_copy_rows(cur, "public.futures_events (exchange, event_type, symbol, raw_data)", batch)
+        except Exception as e:
+            log.error("pg_raw: %s", e)
+        if stop:
+            return
+
+def pg_raw_flush(timeout: float = 10.0) -> bool:
+    """
+    Дописать накопленные события в futures_events и остановить фоновый
+    поток (при остановке бота, до pg_close_pool).
+    """
+    global _raw_stopped
+    with _RAW_LOCK:
+        _raw_stopped = True
+        thread = _raw_thread
+    if thread is None:
+        return True
+    try:
+        _RAW_Q.put(None, timeout=timeout)
+    except queue.Full:
+        log.error("pg_raw_flush: queue still full after %.0f s", timeout)
+        return False
+    thread.join(timeout)
+    if thread.is_alive():
+        log.error("pg_raw_flush: writer did not finish in %.0f s", timeout)
+        return False
+    return True
+
 def pg_upsert_position(
     table: str,
     symbol: str,
@@ -102,27 +373,37 @@ def pg_upsert_position(
 ):
     """
     UPSERT в таблицы positions / mirror_positions по ключу (symbol, position_side).
+    Возвращает True, если запись прошла успешно.
     """
     try:
         # Выполняем UPSERT позиции в указанной таблице
         with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute(f"""
-              INSERT INTO public.{table}
-                     (exchange, symbol, position_side,
-                      position_amt, entry_price, realized_pnl, pending)
-              VALUES (%s, %s, %s, %s, %s, %s, %s)
-              ON CONFLICT (symbol, position_side)
-              DO UPDATE SET
-                 exchange      = EXCLUDED.exchange,
-                 position_amt  = EXCLUDED.position_amt,
-                 entry_price   = EXCLUDED.entry_price,
-                 realized_pnl  = EXCLUDED.realized_pnl,
-                 pending       = EXCLUDED.pending,
-                 updated_at    = now()
-            """, (exchange, symbol, side, amt, price, pnl, pending))
+            _execute_prepared(cur, "upsert_pos", table,
+                              (exchange, symbol, side, amt, price, pnl, pending))
+        return True
     except Exception as e:
         # Неудача записывается в лог
         log.error("pg_upsert_position[%s]: %s", table, e)
+        return False
+
+def pg_upsert_positions_many(table: str, rows) -> bool:
+    """
+    Пакетный UPSERT в positions / mirror_positions одним запросом.
+    rows: (exchange, symbol, side, amt, price, pnl, pending); ключи не должны повторяться.
+    """
+    if not rows:
+        return True
+    try:
+        if table not in _PREPARED_TABLES["upsert_pos"]:
+            raise ValueError(f"unknown positions table: {table!r}")
+        with pg_conn() as conn, conn.cursor() as cur:
+            execute_values(cur,
+                           _UPSERT_POS_SQL.format(table=table, values="%s"),
+                           rows, page_size=500)
+        return True
+    except Exception as e:
+        log.error("pg_upsert_positions_many[%s]: %s", table, e)
+        return False
 
 def pg_delete_position(table: str, symbol: str, side: str):
     """
@@ -131,10 +412,7 @@ def pg_delete_position(table: str, symbol: str, side: str):
     try:
         # Удаляем запись о позиции из таблицы
         with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute(
-                f"DELETE FROM public.{table} WHERE symbol=%s AND position_side=%s",
-                (symbol, side)
-            )
+            _execute_prepared(cur, "del_pos", table, (symbol, side))
     except Exception as e:
         log.error("pg_delete_position[%s]: %s", table, e)
 
@@ -145,11 +423,7 @@ def pg_get_position(table: str, symbol: str, side: str) -> Optional[Tuple[float,
     try:
         # Читаем одну строку о позиции из указанной таблицы
         with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute(f"""
-                SELECT position_amt, entry_price, realized_pnl
-                  FROM public.{table}
-                 WHERE symbol=%s AND position_side=%s
-            """, (symbol, side))
+            _execute_prepared(cur, "get_pos", table, (symbol, side))
             row = cur.fetchone()
             if row:
                 return (float(row[0] or 0), float(row[1] or 0), float(row[2] or 0))
@@ -175,7 +449,7 @@ def reset_pending():
     try:
         # Снимаем флаг pending у всех позиций основного аккаунта
         with pg_conn() as conn, conn.cursor() as cur:
-            cur.execute("UPDATE public.positions SET pending=false WHERE exchange='binance';")
+            cur.execute("UPDATE public.positions SET pending=false WHERE exchange='binance' AND pending;")
     except Exception as e:
         log.error("reset_pending: %s", e)
 
@@ -195,21 +469,27 @@ def pg_insert_closed_trade(
     take_price: float = 0.0,
     reason: str = "market",
     rr: float = 0.0,
+    close_table: Optional[str] = None,
 ):
-    """Записываем информацию о закрытой сделке."""
-    from datetime import datetime
-
-    # Если даты не переданы, используем текущий момент
-    if closed_at is None:
-        closed_at = datetime.utcnow()
-    if created_at is None:
-        created_at = closed_at
-
+    """
+    Записываем информацию о закрытой сделке. Если задан ``close_table``,
+    позиция удаляется из этой таблицы тем же запросом (одна транзакция).
+    """
     try:
-        # Добавляем строку в таблицу closed_trades
+        # Имя таблицы попадает в текст SQL — допускаем только таблицы позиций
+        if close_table and close_table not in _PREPARED_TABLES["del_pos"]:
+            raise ValueError(f"unknown positions table: {close_table!r}")
+        # Добавляем строку в таблицу closed_trades; не переданные даты берёт
+        # сервер (текущий момент UTC, created_at по умолчанию равен closed_at)
         with pg_conn() as conn, conn.cursor() as cur:
+            # Удаление позиции — во writable CTE перед вставкой сделки
+            prefix, key = "", ()
+            if close_table:
+                prefix = (f"WITH _closed AS (DELETE FROM public.{close_table} "
+                          "WHERE symbol=%s AND position_side=%s) ")
+                key = (symbol, side)
             cur.execute(
-                """
+                prefix + """
                 INSERT INTO public.closed_trades
                        (symbol, position_side, volume, pnl,
                         fake_volume, fake_pnl,
@@ -219,12 +499,13 @@ def pg_insert_closed_trade(
                         reason, rr)
                 VALUES (%s, %s, %s, %s,
                         %s, %s,
-                        %s, %s,
+                        COALESCE(%s, now() AT TIME ZONE 'utc'),
+                        COALESCE(%s, %s, now() AT TIME ZONE 'utc'),
                         %s, %s,
                         %s, %s,
                         %s, %s)
                 """,
-                (
+                key + (
                     symbol,
                     side,
                     volume,
@@ -233,6 +514,7 @@ def pg_insert_closed_trade(
                     fake_pnl,
                     closed_at,
                     created_at,
+                    closed_at,
                     entry_price,
                     exit_price,
                     stop_price,
@@ -246,7 +528,6 @@ def pg_insert_closed_trade(
 
 def pg_get_closed_trades_for_month(year: int, month: int):
     """Возвращает список закрытых сделок за указанный месяц."""
-    from datetime import datetime
     # Формируем границы месяца
     if month == 12:
         start = datetime(year, month, 1)
@@ -255,7 +536,8 @@ def pg_get_closed_trades_for_month(year: int, month: int):
         start = datetime(year, month, 1)
         end = datetime(year, month + 1, 1)
     try:
-        # Запрашиваем все записи за указанный период
+        # Запрашиваем все записи за указанный период; диапазон и сортировку
+        # закрывает индекс closed_trades_closed_at_idx (docs/add_closed_trades_closed_at_index.sql)
         with pg_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 """
@@ -283,7 +565,8 @@ def pg_get_closed_trades_for_month(year: int, month: int):
 def pg_purge_old_futures_events(days: int):
     """Delete futures_events entries older than the specified number of days."""
     try:
-        # Удаляем старые события старше указанного количества дней
+        # Удаляем старые события старше указанного количества дней; нужные
+        # страницы находит BRIN-индекс (docs/add_futures_events_created_at_index.sql)
         with pg_conn() as conn, conn.cursor() as cur:
             cur.execute(
                 """
@@ -0,0 +1,2 @@
+-- Index for the monthly report range scan (pg_get_closed_trades_for_month)
+CREATE INDEX IF NOT EXISTS closed_trades_closed_at_idx ON public.closed_trades (closed_at);
@@ -0,0 +1,3 @@
+-- BRIN index for the daily purge (pg_purge_old_futures_events):
+-- futures_events is append-only, so created_at follows the physical row order
+CREATE INDEX IF NOT EXISTS futures_events_created_at_brin ON public.futures_events USING brin (created_at);
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from alexbot import AlexBot
 
 # ------------------------------------------------------------
@@ -14,6 +15,10 @@ def main():
     # Создаём «корневой» логгер
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)  # Общий уровень DEBUG
+    # Поля о потоках/процессах в формате не используются — не собираем их
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
 
     # 1) Пишем всё в файл (до 10 МБ) с ротацией
     fh = RotatingFileHandler(
@@ -28,7 +33,6 @@ def main():
         fmt="%(asctime)s %(levelname)-8s %(name)s: %(message)s",
         datefmt="%d-%m-%y %H:%M:%S"
     ))
-    logger.addHandler(fh)
 
     # 2) Пишем в консоль только INFO и выше
     ch = logging.StreamHandler()
@@ -37,13 +41,23 @@ def main():
         fmt="%(asctime)s %(levelname)-8s %(message)s",
         datefmt="%d-%m-%y %H:%M:%S"
     ))
-    logger.addHandler(ch)
 
-    # Если логи от python-binance слишком подробные — можно их приглушить:
-    # logging.getLogger("binance").setLevel(logging.INFO)
+    # Запись в файл/консоль выполняет отдельный поток QueueListener; потоки
+    # бота сами форматируют запись (QueueHandler.prepare) и кладут её в очередь
+    log_q = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_q))
+    listener = QueueListener(log_q, fh, ch, respect_handler_level=True)
+    listener.start()
 
-    bot = AlexBot()
-    bot.run()
+    # Отладка сетевых библиотек на каждое сообщение не нужна — приглушаем
+    for name in ("binance", "urllib3", "websockets"):
+        logging.getLogger(name).setLevel(logging.INFO)
+
+    try:
+        bot = AlexBot()
+        bot.run()
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     # Запуск при выполнении файла как скрипта
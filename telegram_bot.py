@@ -1,5 +1,9 @@
 import logging
+import queue
+import threading
+import time
 import requests
+from typing import Optional
 from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, MIRROR_B_TG_CHAT_ID
 
 # ------------------------------------------------------------
@@ -9,14 +13,23 @@ from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, MIRROR_B_TG_CHAT_ID
 
 log = logging.getLogger(__name__)
 
+# Максимальная длина одного сообщения Telegram
+TG_MAX_LEN = 4096
+
+# Общая keep-alive сессия: TLS-соединение с api.telegram.org переиспользуется
+_session = requests.Session()
+
+# URL метода sendMessage собираем один раз
+_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+
 def tg_send(chat_id: str, text: str):
     """Отправить текстовое сообщение в Telegram."""
     if not (TELEGRAM_BOT_TOKEN and chat_id):
         return
     try:
         # Выполняем POST-запрос к API Telegram
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+        response = _session.post(
+            _SEND_URL,
             json={"chat_id": chat_id, "text": text},
             timeout=10
         )
@@ -30,12 +43,107 @@ def tg_send(chat_id: str, text: str):
     except Exception as e:
         log.error("tg_send: %s", e)
 
-def tg_a(txt: str):
-    """Отправить сообщение в основной чат и записать его в лог."""
-    log.info(f"[tg_a] {txt}")
-    tg_send(TELEGRAM_CHAT_ID, txt)
+# Очередь исходящих сообщений: отправляет фоновый поток, вызывающий не ждёт API
+_TG_Q: "queue.Queue[tuple]" = queue.Queue()
+_TG_WAIT = 0.1        # сколько ждать соседних заметок о стопах/тейках, секунд
+_TG_LOCK = threading.Lock()
+_tg_thread: Optional[threading.Thread] = None
+# Сколько сообщений поставлено, но ещё не отправлено (для tg_flush)
+_tg_pending = 0
+_TG_DONE = threading.Condition()
+
+def _tg_put(chat_id: str, txt: str, coalesce: bool = False):
+    """Поставить сообщение в очередь, при первом вызове запустить отправителя."""
+    global _tg_thread, _tg_pending
+    if _tg_thread is None:
+        with _TG_LOCK:
+            if _tg_thread is None:
+                _tg_thread = threading.Thread(target=_tg_worker, name="tg-send", daemon=True)
+                _tg_thread.start()
+    with _TG_DONE:
+        _tg_pending += 1
+    _TG_Q.put((chat_id, txt, coalesce))
+
+def _tg_done(n: int):
+    """Отметить ``n`` сообщений отправленными и разбудить tg_flush."""
+    global _tg_pending
+    with _TG_DONE:
+        _tg_pending -= n
+        if _tg_pending <= 0:
+            _TG_DONE.notify_all()
 
-def tg_m(txt: str):
+def _tg_worker():
+    """
+    Фоновая отправка. Обычные сообщения уходят сразу; заметки о стопах/тейках
+    (``coalesce``), пришедшие в один чат в пределах _TG_WAIT, склеиваются.
+    """
+    held = None
+    while True:
+        item = held if held is not None else _TG_Q.get()
+        held = None
+        chat_id, txt, coalesce = item
+        group = [txt]
+        if coalesce:
+            deadline = time.monotonic() + _TG_WAIT
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    nxt = _TG_Q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if nxt[0] != chat_id or not nxt[2]:
+                    # Другое сообщение отправим следующим — порядок сохраняется
+                    held = nxt
+                    break
+                group.append(nxt[1])
+        try:
+            for chunk in tg_chunks(group):
+                tg_send(chat_id, chunk)
+        finally:
+            _tg_done(len(group))
+
+def tg_flush(timeout: float = 10.0) -> bool:
+    """Дождаться отправки всех сообщений из очереди (при остановке бота)."""
+    with _TG_DONE:
+        if _TG_DONE.wait_for(lambda: _tg_pending <= 0, timeout):
+            return True
+        log.error("tg_flush: %d messages not sent", _tg_pending)
+        return False
+
+def tg_a(txt: str, coalesce: bool = False):
+    """
+    Отправить сообщение в основной чат и записать его в лог.
+    ``coalesce`` — заметка о стопе/тейке, её можно склеить с соседними.
+    """
+    log.info("[tg_a] %s", txt)
+    _tg_put(TELEGRAM_CHAT_ID, txt, coalesce)
+
+def tg_m(txt: str, coalesce: bool = False):
     """Отправить сообщение в зеркальный чат и записать его в лог."""
-    log.info(f"[tg_m] {txt}")
-    tg_send(MIRROR_B_TG_CHAT_ID, txt)
\ No newline at end of file
+    log.info("[tg_m] %s", txt)
+    _tg_put(MIRROR_B_TG_CHAT_ID, txt, coalesce)
+
+def tg_chunks(texts, limit: int = TG_MAX_LEN):
+    """Склеиваем строки через перевод строки в куски не длиннее ``limit``."""
+    buf = ""
+    for txt in texts:
+        # Слишком длинную строку режем на части
+        while len(txt) > limit:
+            if buf:
+                yield buf
+                buf = ""
+            yield txt[:limit]
+            txt = txt[limit:]
+        if buf and len(buf) + 1 + len(txt) > limit:
+            yield buf
+            buf = ""
+        buf = f"{buf}\n{txt}" if buf else txt
+    if buf:
+        yield buf
+
+def tg_m_many(texts):
+    """Отправить набор строк в зеркальный чат минимальным числом сообщений."""
+    for chunk in tg_chunks(texts):
+        tg_m(chunk)